@@ -1,25 +1,67 @@
 # app.py
+from __future__ import annotations
+
 import os
 import io
+import copy
+import base64
+import mimetypes
 import uuid
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
-from typing import List, Optional, Dict, Tuple
+from urllib.parse import urljoin
+from typing import TYPE_CHECKING, List, Optional, Dict, Tuple
 import streamlit as st
-from supabase import create_client, Client
+
+if TYPE_CHECKING:  # supabase (gotrue, postgrest, storage3, httpx…) importé à la première connexion
+    from supabase import Client
 
 # ─────────── Configuration générale ───────────
 st.set_page_config(page_title="Suivi d’avancement", page_icon="📊", layout="wide")
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "").strip()
 SUPABASE_KEY = os.getenv("SUPABASE_ANON_KEY", "").strip()
+SUPABASE_HOST = SUPABASE_URL.split("//", 1)[-1].split("/", 1)[0]
 BUCKET_PV = os.getenv("PV_BUCKET", "pv-chantier")
 FORCE_PUBLIC_URLS = os.getenv("FORCE_PUBLIC_URLS", "true").lower() in ("1", "true", "yes")
+# Table d'index des PV (optionnelle, vide = désactivée) : une ligne par fichier déposé
+#   project_id, file_name, file_path, uploaded_by, uploaded_at (default now())
+#   index conseillé : create index on <table> (project_id, file_path desc)
+#   (file_path = <projet>/<YYYYMMDD>/… : l'ordre du chemin est celui de la date du PV)
+PV_LOG_TABLE = os.getenv("PV_LOG_TABLE", "").strip()
 
 MAX_UPLOAD_MB = 200
-ALLOWED_EXT = {".pdf", ".doc", ".docx"}
+TUS_CHUNK = 6 * 1024 * 1024  # au-delà : upload résumable, blocs de 6 MB (taille imposée)
+PV_CACHE_CONTROL = "31536000"  # chemins préfixés d'un uuid : contenu immuable
+UPLOAD_CONCURRENCY = 4  # envois simultanés max par lot de PV
+UPLOAD_WORKERS = 16  # envois simultanés max pour tout le process
+LIST_WORKERS = 16  # listings Storage simultanés max pour tout le process
+STORAGE_LIST_LIMIT = 1000  # entrées par appel list() (défaut storage3 : 100)
+PAGE_SIZE = 500  # lignes max par INSERT groupé
+PV_URL_TTL = 3600  # durée de validité des URLs signées (s)
+PV_HISTORY_LIMIT = 50  # PV lus dans l'index par page (« Afficher plus » charge la suivante)
+ALLOWED_EXT = frozenset({".pdf", ".doc", ".docx"})
+_ALLOWED_EXT_NODOT = frozenset(e.lstrip(".") for e in ALLOWED_EXT)
+_RE_UNSAFE = re.compile(r"[^A-Za-z0-9._-]")
+_RE_YMD = re.compile(r"\d{8}")
+
+# État de session initial (posé une fois par session dans main)
+DEFAULT_STATE = {
+    "user": None,
+    "pv_cache": {},  # project_id -> {"exp": ts, "items": [...]}
+    "pending_updates": [],  # mises à jour en attente d'un INSERT groupé
+}
 
 # ─────────── Fonctions utilitaires ───────────
+def init_state():
+    ss = st.session_state
+    if "_initialized" in ss:
+        return
+    ss.update({k: copy.copy(v) for k, v in DEFAULT_STATE.items() if k not in ss})
+    ss["_initialized"] = True
+
 def human_bytes(n: int) -> str:
     for u in ["B", "KB", "MB", "GB"]:
         if n < 1024.0:
@@ -28,17 +70,31 @@ def human_bytes(n: int) -> str:
     return f"{n:.1f}TB"
 
 def safe_filename(name: str) -> str:
-    base = os.path.basename(name).replace(" ", "_")
-    return re.sub(r"[^A-Za-z0-9._-]", "_", base)
+    # un seul passage : l'espace fait partie des caractères remplacés par "_"
+    return _RE_UNSAFE.sub("_", os.path.basename(name))
+
+def ext_ok(name: str) -> bool:
+    _, dot, ext = name.rpartition(".")
+    return bool(dot) and ext.lower() in _ALLOWED_EXT_NODOT
+
+def pv_date_from_path(path: str) -> str:
+    """Date du PV (YYYY-MM-DD) tirée du dossier <projet>/<YYYYMMDD>/…, sinon « inconnu »."""
+    parts = path.split("/")
+    if len(parts) >= 2 and _RE_YMD.fullmatch(parts[1]):
+        ymd = parts[1]
+        return f"{ymd[:4]}-{ymd[4:6]}-{ymd[6:]}"
+    return "inconnu"
+
+def storage_prefix(project_id: str, d: date) -> str:
+    return f"{project_id}/{d.strftime('%Y%m%d')}"
 
-def make_storage_path(project_id: str, d: date, original_name: str) -> str:
-    ymd = d.strftime("%Y%m%d")
-    return f"{project_id}/{ymd}/{uuid.uuid4().hex}_{safe_filename(original_name)}"
+def make_storage_path(prefix: str, original_name: str) -> str:
+    return f"{prefix}/{uuid.uuid4().hex}_{safe_filename(original_name)}"
 
-def dns_probe(url: str):
+@st.cache_data(ttl=300, show_spinner=False)
+def dns_probe(host: str):
     import socket
     try:
-        host = url.split("//", 1)[-1].split("/", 1)[0]
         return socket.gethostbyname(host)
     except Exception:
         return None
@@ -56,17 +112,59 @@ def to_signed_url(sb: Client, bucket: str, path: str, expires=3600):
     except Exception:
         return to_public_url(sb, bucket, path)
 
+def to_signed_urls(sb: Client, bucket: str, paths: List[str], expires=3600) -> Dict[str, str]:
+    """Signe tous les chemins en un seul appel Storage.
+
+    Repli, pour les seules entrées absentes du lot : signature unitaire puis URL publique.
+    """
+    if not paths:
+        return {}
+    try:
+        signed = sb.storage.from_(bucket).create_signed_urls(paths, expires) or []
+        idx = {s["path"]: s["signedURL"] for s in signed if s.get("path") and s.get("signedURL")}
+    except Exception:
+        # storage3 lève si une seule entrée du lot est en erreur
+        idx = {}
+    return {p: idx.get(p) or to_signed_url(sb, bucket, p, expires) for p in paths}
+
 # ─────────── Connexion Supabase ───────────
+# Le client est partagé par le process : ses sessions httpx (PostgREST, Storage)
+# sont créées une fois puis réutilisées, connexions keep-alive comprises.
 @st.cache_resource(show_spinner=False)
 def get_supabase() -> Client:
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+    import httpx
+    from supabase import create_client, ClientOptions
+
+    options = ClientOptions(
+        postgrest_client_timeout=httpx.Timeout(10.0, connect=3.0),
+        storage_client_timeout=httpx.Timeout(30.0, connect=3.0),
+    )
+    return create_client(SUPABASE_URL, SUPABASE_KEY, options=options)
+
+# Deux pools process distincts, jamais arrêtés : un upload TUS de 200 MB occupe
+# un thread plusieurs minutes et ne doit pas bloquer les listings des autres sessions.
+@st.cache_resource(show_spinner=False)
+def get_upload_pool() -> ThreadPoolExecutor:
+    """Envois Storage : au plus UPLOAD_WORKERS en cours pour tout le process."""
+    return ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="supabase-up")
+
+@st.cache_resource(show_spinner=False)
+def get_list_pool() -> ThreadPoolExecutor:
+    """Listings Storage (requêtes courtes)."""
+    return ThreadPoolExecutor(max_workers=LIST_WORKERS, thread_name_prefix="supabase-list")
 
 def test_connectivity_panel():
-    with st.expander("Diagnostic rapide", expanded=False):
-        ip = dns_probe(SUPABASE_URL) or "—"
-        st.success(f"DNS OK → **{SUPABASE_URL.split('//')[-1]}** : {ip}")
+    with st.sidebar.expander("Diagnostic rapide", expanded=False):
+        ip = dns_probe(SUPABASE_HOST) or "—"
+        st.success(f"DNS OK → **{SUPABASE_HOST}** : {ip}")
 
 # ─────────── Authentification ───────────
+def reset_user_state():
+    """À la connexion / déconnexion : rien du compte précédent ne reste en session."""
+    fetch_projects.clear()
+    st.session_state["pending_updates"] = []
+    st.session_state["pv_cache"] = {}  # listes et URLs signées du compte précédent
+
 def login_panel(sb: Client):
     st.subheader("Connexion")
     mode = st.radio(" ", ["Se connecter", "Créer un compte"], horizontal=True, label_visibility="collapsed")
@@ -79,6 +177,7 @@ def login_panel(sb: Client):
         try:
             res = sb.auth.sign_in_with_password({"email": email, "password": pwd})
             st.session_state["user"] = res.user
+            reset_user_state()
             st.success("Connecté.")
             st.rerun()
         except Exception as e:
@@ -87,6 +186,7 @@ def login_panel(sb: Client):
         try:
             res = sb.auth.sign_up({"email": email, "password": pwd})
             st.session_state["user"] = res.user
+            reset_user_state()
             st.success("Compte créé (vérifie ton email).")
             st.rerun()
         except Exception as e:
@@ -97,119 +197,297 @@ def login_panel(sb: Client):
         if col2.button("Se déconnecter"):
             sb.auth.sign_out()
             st.session_state.pop("user", None)
+            reset_user_state()
             st.rerun()
     return user
 
 # ─────────── Liste des projets ───────────
-def list_projects(sb: Client):
+# st.cache_data est global à toutes les sessions : la clé inclut l'utilisateur,
+# ce qui donne une entrée par compte. Ce n'est PAS une isolation RLS : la requête
+# passe par le client partagé get_supabase(), dont le jeton est celui du dernier
+# compte connecté dans le process.
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_projects(user_id: Optional[str]) -> Dict[str, str]:
+    """Projets visibles, id -> nom (triés par nom), construit une fois par entrée de cache."""
+    res = get_supabase().table("projects").select("id,name").order("name").execute()
+    return {p["id"]: p["name"] for p in res.data or []}
+
+def list_projects(user_id: Optional[str]) -> Dict[str, str]:
     try:
-        res = sb.table("projects").select("id,name").order("name").execute()
-        return res.data or []
+        return fetch_projects(user_id)
     except Exception as e:
         st.warning(f"Erreur chargement projets : {e}")
-        return []
+        return {}
+
+# ─────────── Mises à jour ───────────
+def insert_project_updates_bulk(sb: Client, payloads: List[Dict]) -> int:
+    """Insère les mises à jour par paquets de PAGE_SIZE (un appel REST par paquet).
+
+    Prefer: return=minimal — les lignes insérées ne sont pas renvoyées.
+    """
+    for i in range(0, len(payloads), PAGE_SIZE):
+        sb.table("project_updates").insert(payloads[i:i + PAGE_SIZE], returning="minimal").execute()
+    return len(payloads)
 
 # ─────────── Upload fichiers ───────────
-def upload_pv_files(sb: Client, project_id: str, the_date: date, files):
-    from_ = sb.storage.from_(BUCKET_PV)
-    ok, rows = 0, []
-    if not files:
-        return ok, rows
-    for f in files:
+def split_pv_files(files) -> Tuple[list, List[Tuple[str, str]]]:
+    """Sépare les fichiers acceptés des refusés (nom, motif), sans aucun appel réseau."""
+    good, bad = [], []
+    for f in files or []:
         name = getattr(f, "name", "file")
-        if not any(name.lower().endswith(ext) for ext in ALLOWED_EXT):
-            st.warning(f"Ignoré (extension non autorisée) : {name}")
+        if not ext_ok(name):
+            bad.append((name, "extension non autorisée"))
             continue
-        content = f.getvalue()
-        if len(content) > MAX_UPLOAD_MB * 1024 * 1024:
-            st.warning(f"Ignoré (>{MAX_UPLOAD_MB} MB) : {name}")
+        # UploadedFile expose sa taille : pas de copie des octets pour la refuser
+        size = getattr(f, "size", None)
+        if size is None:
+            size = len(f.getvalue())
+        if size > MAX_UPLOAD_MB * 1024 * 1024:
+            bad.append((name, f">{MAX_UPLOAD_MB} MB"))
             continue
-        path = make_storage_path(project_id, the_date, name)
+        good.append(f)
+    return good, bad
+
+def upload_pv_files(sb: Client, project_id: str, the_date: date, files, user_id: Optional[str] = None):
+    from_ = sb.storage.from_(BUCKET_PV)
+    ok, rows = 0, []
+    good, bad = split_pv_files(files)
+    for name, why in bad:
+        st.warning(f"Ignoré ({why}) : {name}")
+    if not good:
+        return ok, rows
+    prefix = storage_prefix(project_id, the_date)  # une fois par lot
+    todo = [(f.name, make_storage_path(prefix, f.name), f) for f in good]
+
+    # Envois en parallèle : pas d'appel st.* dans les threads
+    def _upload_one(item):
+        name, path, f = item
+        mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        size = getattr(f, "size", 0)
         try:
-            from_.upload(path, content)
+            if size > TUS_CHUNK:
+                tus_upload(sb, BUCKET_PV, path, f, size, mime)
+            else:
+                from_.upload(path, f.getvalue(), {"content-type": mime, "cache-control": PV_CACHE_CONTROL})
+            return None
+        except Exception as e:
+            return e
+
+    # Au plus UPLOAD_CONCURRENCY envois simultanés par lot (limites de débit Storage)
+    lanes = min(UPLOAD_CONCURRENCY, len(todo))
+    results = [None] * len(todo)
+
+    def _lane(i):
+        for j in range(i, len(todo), lanes):
+            results[j] = _upload_one(todo[j])
+
+    list(get_upload_pool().map(_lane, range(lanes)))
+    for (name, path, _), err in zip(todo, results):
+        if err is None:
             rows.append({"path": path, "name": name})
             ok += 1
+        else:
+            st.error(f"Erreur upload {name} : {err}")
+
+    if rows and PV_LOG_TABLE:
+        log_rows = [
+            {"project_id": project_id, "file_name": r["name"], "file_path": r["path"], "uploaded_by": user_id}
+            for r in rows
+        ]
+        try:
+            sb.table(PV_LOG_TABLE).insert(log_rows, returning="minimal").execute()
         except Exception as e:
-            st.error(f"Erreur upload {name} : {e}")
+            st.warning(f"Fichiers déposés mais non indexés : {e}")
     return ok, rows
 
+def tus_upload(sb: Client, bucket: str, path: str, f, size: int, content_type: str, retries: int = 2):
+    """Upload résumable (protocole TUS) : un seul bloc en mémoire, reprise à l'offset serveur."""
+    import httpx
+
+    http = sb.storage.session
+    meta = {"bucketName": bucket, "objectName": path, "contentType": content_type, "cacheControl": PV_CACHE_CONTROL}
+    res = http.post("upload/resumable", headers={
+        "Tus-Resumable": "1.0.0",
+        "Upload-Length": str(size),
+        "Upload-Metadata": ",".join(f"{k} {base64.b64encode(v.encode()).decode()}" for k, v in meta.items()),
+    })
+    res.raise_for_status()
+    location = urljoin(str(http.base_url), res.headers["Location"])
+    offset = 0
+    f.seek(0)
+    while offset < size:
+        chunk = f.read(TUS_CHUNK)
+        try:
+            r = http.patch(location, content=chunk, headers={
+                "Tus-Resumable": "1.0.0",
+                "Upload-Offset": str(offset),
+                "Content-Type": "application/offset+octet-stream",
+            })
+            r.raise_for_status()
+            offset = int(r.headers.get("Upload-Offset", offset + len(chunk)))
+        except httpx.HTTPError:
+            if retries <= 0:
+                raise
+            retries -= 1
+            head = http.head(location, headers={"Tus-Resumable": "1.0.0"})
+            head.raise_for_status()
+            offset = int(head.headers["Upload-Offset"])
+        f.seek(offset)
+
 # ─────────── Historique des PV ───────────
 def storage_list_recursive(sb: Client, bucket: str, prefix: str):
-    """Version robuste qui ignore les None."""
-    out, stack = [], [prefix.rstrip("/") + "/"] if prefix else [""]
+    """Version robuste qui ignore les None ; chaque niveau de dossiers est listé en parallèle."""
     from_ = sb.storage.from_(bucket)
-    while stack:
-        cur = stack.pop()
+
+    def _list(cur):
+        entries, offset = [], 0
         try:
-            entries = from_.list(cur) or []
+            while True:
+                page = from_.list(cur, {"limit": STORAGE_LIST_LIMIT, "offset": offset}) or []
+                entries.extend(page)
+                if len(page) < STORAGE_LIST_LIMIT:
+                    return cur, entries
+                offset += STORAGE_LIST_LIMIT
         except Exception:
-            entries = []
-        for e in entries:
-            if not isinstance(e, dict):  # ignore None
-                continue
-            e_type = e.get("type") or (e.get("metadata") or {}).get("type")
-            name = e.get("name")
-            if not name:
-                continue
-            full = (cur + name).lstrip("/")
-            if e_type == "folder":
-                stack.append(full + "/")
-            else:
-                e["full_path"] = full
-                out.append(e)
+            return cur, entries
+
+    out, level = [], [prefix.rstrip("/") + "/"] if prefix else [""]
+    pool = get_list_pool()
+    while level:
+        nxt = []
+        for cur, entries in pool.map(_list, level):
+            for e in entries:
+                if not isinstance(e, dict):  # ignore None
+                    continue
+                e_type = e.get("type") or (e.get("metadata") or {}).get("type")
+                name = e.get("name")
+                if not name:
+                    continue
+                full = (cur + name).lstrip("/")
+                # Storage renvoie les dossiers sans id ni metadata
+                if e_type == "folder" or e.get("id") is None:
+                    nxt.append(full + "/")
+                else:
+                    e["full_path"] = full
+                    out.append(e)
+        level = nxt
     return out
 
+def _pv_items_from_log(sb: Client, project_id: str, after: Optional[str] = None) -> Tuple[List[Dict], bool]:
+    """Une page de l'index, ordre file_path décroissant : (items, page suivante ?).
+
+    Pagination par curseur (file_path < dernier chemin vu), pas par offset : un
+    dépôt entre deux pages ne décale rien. Une ligne de plus que la page est
+    demandée : sa présence indique qu'il reste des PV.
+    """
+    q = sb.table(PV_LOG_TABLE).select("file_name,file_path").eq("project_id", project_id)
+    if after:
+        q = q.lt("file_path", after)
+    res = q.order("file_path", desc=True).limit(PV_HISTORY_LIMIT + 1).execute()
+    rows = res.data or []
+    items = [
+        {"path": r["file_path"], "name": r.get("file_name") or r["file_path"].rsplit("/", 1)[-1],
+         "date": pv_date_from_path(r["file_path"])}
+        for r in rows[:PV_HISTORY_LIMIT]
+    ]
+    return items, len(rows) > PV_HISTORY_LIMIT
+
+def _pv_items_from_storage(sb: Client, project_id: str) -> List[Dict]:
+    items = []
+    for e in storage_list_recursive(sb, BUCKET_PV, project_id):
+        path = e.get("full_path", "")
+        items.append({"path": path, "name": path.rsplit("/", 1)[-1], "date": pv_date_from_path(path)})
+    return items
+
+def list_signed_pv(
+    sb: Client, project_id: str, expires=PV_URL_TTL, after: Optional[str] = None
+) -> Tuple[List[Dict], bool]:
+    """PV du projet : ([{path, name, date, url}] triés par date décroissante, page suivante ?).
+
+    Avec PV_LOG_TABLE : une page indexée de PV_HISTORY_LIMIT lignes après le
+    chemin `after`, dans l'ordre de la base (les pages s'enchaînent) ; sinon
+    parcours complet des dossiers Storage (jamais de suite).
+    """
+    if PV_LOG_TABLE:
+        items, more = _pv_items_from_log(sb, project_id, after)
+    else:
+        items, more = _pv_items_from_storage(sb, project_id), False
+        items.sort(key=lambda it: it["path"])
+        items.sort(key=lambda it: it["date"], reverse=True)
+
+    paths = [it["path"] for it in items]
+    if FORCE_PUBLIC_URLS:
+        urls = [to_public_url(sb, BUCKET_PV, p) for p in paths]
+    else:
+        signed = to_signed_urls(sb, BUCKET_PV, paths, expires)
+        urls = [signed[p] for p in paths]
+    for it, url in zip(items, urls):
+        it["url"] = url
+    return items, more
+
+def cached_signed_pv(sb: Client, project_id: str) -> Dict:
+    """Mémorise la liste par session ; rafraîchie avant l'expiration des URLs signées.
+
+    Renvoie l'entrée {"exp", "items", "more"} ; `more` : page suivante possible.
+    """
+    cache = st.session_state["pv_cache"]
+    entry = cache.get(project_id)
+    if entry and entry["exp"] > time.time():
+        return entry
+    items, more = list_signed_pv(sb, project_id, PV_URL_TTL)
+    entry = {"exp": time.time() + PV_URL_TTL - 300, "items": items, "more": more}
+    cache[project_id] = entry
+    return entry
+
+def load_more_pv(sb: Client, entry: Dict, project_id: str):
+    """Ajoute la page suivante de l'index à une entrée du cache."""
+    items = entry["items"]
+    after = items[-1]["path"] if items else None
+    page, entry["more"] = list_signed_pv(sb, project_id, PV_URL_TTL, after=after)
+    items.extend(page)
+
+@st.fragment
 def render_pv_history(sb: Client, project_id: str):
-    st.markdown("### 📎 Pièces jointes — PV de chantier")
+    """Fragment : le bouton « Actualiser » ne relance que ce bloc, pas toute la page."""
+    c1, c2 = st.columns([4, 1])
+    c1.markdown("### 📎 Pièces jointes — PV de chantier")
+    if c2.button("Actualiser", key="pv_refresh"):
+        st.session_state["pv_cache"].pop(project_id, None)
     try:
-        entries = storage_list_recursive(sb, BUCKET_PV, project_id)
+        entry = cached_signed_pv(sb, project_id)
+        if st.session_state.get("pv_more") and entry["more"]:
+            load_more_pv(sb, entry, project_id)
     except Exception as e:
         st.error(f"Erreur lecture Storage : {e}")
         return
-    files = [e for e in entries if isinstance(e, dict) and (e.get("type") == "file" or e.get("name"))]
-    if not files:
+    items = entry["items"]
+    if not items:
         st.info("Aucun PV pour ce projet.")
         return
 
-    # Regroupement par date extraite du chemin
-    groups = {}
-    for e in files:
-        path = e.get("full_path", "")
-        parts = path.split("/")
-        ymd = "inconnu"
-        if len(parts) >= 2 and re.fullmatch(r"\d{8}", parts[1]):
-            y, m, d = parts[1][:4], parts[1][4:6], parts[1][6:]
-            ymd = f"{y}-{m}-{d}"
-        groups.setdefault(ymd, []).append(e)
-
-    for ymd in sorted(groups.keys(), reverse=True):
-        st.markdown(f"**{ymd}**")
-        for e in sorted(groups[ymd], key=lambda x: x.get("full_path", "")):
-            path = e.get("full_path", "")
-            fname = path.split("/", 3)[-1]
-            url = to_public_url(sb, BUCKET_PV, path) if FORCE_PUBLIC_URLS else to_signed_url(sb, BUCKET_PV, path)
-            st.write(f"- [{fname}]({url})")
+    # Un seul élément (et une seule trame websocket) pour toute la liste
+    st.dataframe(
+        [{"Date": it["date"], "Fichier": it["name"], "url": it["url"]} for it in items],
+        column_config={"url": st.column_config.LinkColumn("Lien", display_text="Ouvrir")},
+        hide_index=True,
+        use_container_width=True,
+    )
+    if entry["more"]:
+        st.button("Afficher plus", key="pv_more")
 
 # ─────────── Formulaire principal ───────────
-def form_panel(sb: Client, projects):
+def form_panel(sb: Client, id_to_name: Dict[str, str]):
     st.header("Suivi d’avancement — Saisie")
-    if not projects:
+    if not id_to_name:
         st.info("Aucun projet disponible.")
         return
 
-    names = [p["name"] for p in projects]
-    default = 0
-    saved = st.session_state.get("selected_project_id")
-    if saved:
-        for i, p in enumerate(projects):
-            if p["id"] == saved:
-                default = i
-                break
-    name = st.selectbox("Projet", names, index=default)
-    project_id = next(p["id"] for p in projects if p["name"] == name)
-    st.session_state["selected_project_id"] = project_id
-
-    with st.form("update_form"):
+    # Le selectbox stocke directement l'id choisi sous sa clé ; on oublie un id disparu
+    if st.session_state.get("selected_project_id") not in id_to_name:
+        st.session_state.pop("selected_project_id", None)
+    project_id = st.selectbox("Projet", list(id_to_name), format_func=id_to_name.get, key="selected_project_id")
+
+    with st.form("update_form", clear_on_submit=True):
         col1, col2 = st.columns(2)
         with col1:
             t = st.number_input("Progression travaux (%)", 0.0, 100.0, 0.0)
@@ -219,15 +497,21 @@ def form_panel(sb: Client, projects):
         com = st.text_area("Commentaires", placeholder="Observations…")
         st.markdown("#### Joindre le PV (PDF/DOCX/DOC)")
         files = st.file_uploader(" ", type=["pdf", "doc", "docx"], accept_multiple_files=True, label_visibility="collapsed")
-        sub = st.form_submit_button("Enregistrer la mise à jour", type="primary")
+        c1, c2 = st.columns(2)
+        sub = c1.form_submit_button("Enregistrer la mise à jour", type="primary")
+        queue = c2.form_submit_button("Ajouter au lot")
 
-    if sub:
-        user = st.session_state.get("user")
+    if sub or queue:
+        # Lectures de session_state regroupées en tête (proxy avec verrou)
+        ss = st.session_state
+        user = ss.get("user")
         if not user:
             st.error("Veuillez vous connecter.")
             return
         uid = getattr(user, "id", None)
-        nb, _ = upload_pv_files(sb, project_id, d or date.today(), files)
+        nb, _ = upload_pv_files(sb, project_id, d or date.today(), files, uid)
+        if nb:
+            ss["pv_cache"].pop(project_id, None)
         data = {
             "project_id": project_id,
             "updated_by": uid,
@@ -236,17 +520,43 @@ def form_panel(sb: Client, projects):
             "commentaires": com or "",
             "pv_chantier": d.isoformat() if isinstance(d, date) else None,
         }
-        try:
-            sb.table("project_updates").insert(data).execute()
-            st.success(f"Mise à jour enregistrée. Fichiers déposés : {nb}")
-        except Exception as e:
-            st.error(f"Erreur base de données : {e}")
+        if queue:
+            ss["pending_updates"].append(data)
+            st.info(f"Mise à jour ajoutée au lot. Fichiers déposés : {nb}")
+        else:
+            try:
+                insert_project_updates_bulk(sb, [data])
+                st.success(f"Mise à jour enregistrée. Fichiers déposés : {nb}")
+            except Exception as e:
+                st.error(f"Erreur base de données : {e}")
+
+    # Message du lot enregistré, affiché après le rerun qui retire ses boutons
+    done = st.session_state.pop("batch_done", None)
+    if done:
+        st.success(done)
+    pending = st.session_state["pending_updates"]
+    if pending:
+        c1, c2 = st.columns(2)
+        if c1.button(f"Enregistrer le lot ({len(pending)})", type="primary"):
+            try:
+                n = insert_project_updates_bulk(sb, pending)
+            except Exception as e:
+                st.error(f"Erreur base de données : {e}")
+            else:
+                st.session_state["pending_updates"] = []
+                st.session_state["batch_done"] = f"{n} mise(s) à jour enregistrée(s)."
+                st.rerun()
+        if c2.button("Vider le lot"):
+            st.session_state["pending_updates"] = []
+            st.rerun()
+        st.caption("Les PV joints aux mises à jour du lot sont déjà déposés : vider le lot ne les supprime pas.")
 
     st.divider()
     render_pv_history(sb, project_id)
 
 # ─────────── Main ───────────
 def main():
+    init_state()
     try:
         sb = get_supabase()
     except Exception as e:
@@ -262,9 +572,12 @@ def main():
     if st.button("Se déconnecter"):
         sb.auth.sign_out()
         st.session_state.pop("user", None)
+        reset_user_state()
         st.rerun()
 
-    projects = list_projects(sb)
+    if st.button("Actualiser les projets"):
+        fetch_projects.clear()
+    projects = list_projects(getattr(user, "id", None))
     form_panel(sb, projects)
 
 if __name__ == "__main__":